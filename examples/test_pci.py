@@ -1,34 +1,65 @@
+import atexit
 import ctypes
+import logging
 import os
-import random
+import sys
 import mmap
-import struct
 import time
 
-def va_to_pa(va):
-    page_size = os.sysconf(os.sysconf_names['SC_PAGESIZE'])
-    # page_size = 2*1024*1024
-    page_offset = va % page_size
-    pagemap_entry_offset = (va // page_size) * 8  # 每个条目8字节
+import numpy as np
 
-    try:
-        with open('/proc/self/pagemap', 'rb') as f:
-            f.seek(pagemap_entry_offset)
-            entry_bytes = f.read(8)
-            if len(entry_bytes) != 8:
-                raise ValueError("Invalid pagemap entry")
+logger = logging.getLogger(__name__)
 
-            entry = int.from_bytes(entry_bytes, byteorder='little')
-            if not (entry & (1 << 63)):  # 检查页面是否在内存中
-                raise ValueError("Page not present in physical memory")
+_PAGESIZE = mmap.PAGESIZE
+_PAGEMAP_FD = os.open('/proc/self/pagemap', os.O_RDONLY)
+_PAGEMAP_PRESENT = 1 << 63
+_PAGEMAP_PFN_MASK = (1 << 55) - 1
 
-            pfn = entry & 0x7FFFFFFFFFFFFF  # 提取PFN
-            print(f"pfn={hex(pfn)}")
-            return (pfn * page_size) + page_offset
 
-    except IOError as e:
+def _read_pagemap(va, npages):
+    try:
+        entry_bytes = os.pread(_PAGEMAP_FD, 8 * npages, (va // _PAGESIZE) * 8)  # 每个条目8字节
+    except OSError as e:
         raise RuntimeError(f"Failed to access pagemap: {e}")
 
+    if len(entry_bytes) != 8 * npages:
+        raise ValueError("Invalid pagemap entry")
+
+    entries = np.frombuffer(entry_bytes, dtype='<u8')
+    if not np.all(entries & np.uint64(_PAGEMAP_PRESENT)):  # 检查页面是否在内存中
+        raise ValueError("Page not present in physical memory")
+
+    return entries & np.uint64(_PAGEMAP_PFN_MASK)  # 提取PFN
+
+
+def va_to_pa(va):
+    pfn = int(_read_pagemap(va, 1)[0])
+    logger.debug("pfn=%#x", pfn)
+    return (pfn * _PAGESIZE) + va % _PAGESIZE
+
+
+def va_to_pa_pair(va_a, va_b, page_size=_PAGESIZE):
+    """Translate two addresses with a single pagemap read.
+
+    `page_size` is the size of the (physically contiguous) pages backing both addresses;
+    when they fall in the same page only one entry is read.
+    """
+    if va_a // page_size == va_b // page_size:
+        pa_a = va_to_pa(va_a)
+        return pa_a, pa_a + (va_b - va_a)
+
+    first_vpn = min(va_a, va_b) // _PAGESIZE
+    npages = abs(va_a // _PAGESIZE - va_b // _PAGESIZE) + 1
+    pfns = _read_pagemap(first_vpn * _PAGESIZE, npages)
+    pa_a = int(pfns[va_a // _PAGESIZE - first_vpn]) * _PAGESIZE + va_a % _PAGESIZE
+    pa_b = int(pfns[va_b // _PAGESIZE - first_vpn]) * _PAGESIZE + va_b % _PAGESIZE
+    return pa_a, pa_b
+
+
+def va_to_pa_range(va, npages):
+    """Return the physical address of each of the `npages` pages starting at the page containing `va`."""
+    return _read_pagemap(va, npages) * np.uint64(_PAGESIZE)
+
 
 # 定义 mmap 相关常量
 PROT_READ = 1
@@ -37,9 +68,14 @@ MAP_SHARED = 0x01
 MAP_HUGETLB = 0x40000  # 巨页内存标志
 MAP_LOCKED = 0x02000
 MAP_ANONYMOUS = 0x20
+MAP_POPULATE = 0x08000
+MAP_HUGE_SHIFT = 26
+MAP_HUGE_2MB = 21 << MAP_HUGE_SHIFT
+MAP_HUGE_1GB = 30 << MAP_HUGE_SHIFT
+MAP_FAILED = ctypes.c_void_p(-1).value
 
 # 定义 mmap 函数
-libc = ctypes.CDLL("libc.so.6")
+libc = ctypes.CDLL("libc.so.6", use_errno=True)
 cmmap = libc.mmap
 cmmap.restype = ctypes.c_void_p
 cmmap.argtypes = (
@@ -47,47 +83,211 @@ cmmap.argtypes = (
     ctypes.c_int, ctypes.c_int,
     ctypes.c_int, ctypes.c_long
 )
+libc.madvise.restype = ctypes.c_int
+libc.madvise.argtypes = (ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int)
+libc.munmap.restype = ctypes.c_int
+libc.munmap.argtypes = (ctypes.c_void_p, ctypes.c_size_t)
+libc.mlock.restype = ctypes.c_int
+libc.mlock.argtypes = (ctypes.c_void_p, ctypes.c_size_t)
+
+
+def _default_hugepage_size():
+    """Default huge page size in bytes, as reported by Hugepagesize in /proc/meminfo."""
+    with open('/proc/meminfo') as f:
+        for line in f:
+            if line.startswith('Hugepagesize:'):
+                return int(line.split()[1]) * 1024  # 单位是 kB
+    raise OSError("Hugepagesize not found in /proc/meminfo")
+
+
+def mmap_with_hugepage_fallback(size):
+    """Map `size` bytes of locked shared memory, preferring the largest usable huge page.
+
+    Tries 1 GB pages (only when `size` does not fit in a 2 MB page), then 2 MB pages, then the
+    default huge page size. The device DMAs into the buffer by physical address, so it must sit
+    in a single huge page: tiers whose page is smaller than `size` are skipped and normal pages
+    are never used. Returns `(addr, page_size)`.
+    """
+    candidates = []
+    if size > 2 * 1024 * 1024:
+        candidates.append((MAP_HUGETLB | MAP_HUGE_1GB, 1024 * 1024 * 1024, "1GB"))
+    candidates.append((MAP_HUGETLB | MAP_HUGE_2MB, 2 * 1024 * 1024, "2MB"))
+    candidates.append((MAP_HUGETLB, _default_hugepage_size(), "default size"))
+
+    for extra_flags, page_size, name in candidates:
+        if page_size < size:
+            continue  # 巨页比缓冲区小, 物理地址不连续
+        addr = cmmap(
+            0, size,
+            PROT_READ | PROT_WRITE,
+            MAP_SHARED | MAP_ANONYMOUS | MAP_LOCKED | MAP_POPULATE | extra_flags,
+            -1, 0
+        )
+        if addr is None or addr == MAP_FAILED:
+            continue
+        logger.info("DMA buffer uses %s huge pages", name)
+        return addr, page_size
+
+    raise OSError(ctypes.get_errno(), f"Failed to allocate huge page memory for a {size} byte DMA buffer")
+
+
+def advise_dma_buffer(addr, size):
+    """Keep the buffer out of forked children."""
+    if libc.madvise(addr, size, mmap.MADV_DONTFORK) != 0:
+        raise OSError(ctypes.get_errno(), "Failed to madvise DMA buffer memory")
+
+
+def pin_dma_buffer(addr, size):
+    """Fault in and lock the buffer so its pagemap entries are present before va_to_pa reads them."""
+    ctypes.memset(addr, 0, 1)  # 写一次, 确保页面已分配
+    if libc.mlock(addr, size) != 0:
+        raise OSError(ctypes.get_errno(), "Failed to lock DMA buffer memory")
+
 
 # 申请 2MB 巨页内存
 size = 2 * 1024 * 1024  # 2MB
-addr = cmmap(
-    0, size,
-    PROT_READ | PROT_WRITE,
-    MAP_SHARED | MAP_ANONYMOUS | MAP_HUGETLB | MAP_LOCKED,
-    -1, 0
-)
 
-if addr == -1:
-    raise OSError("Failed to allocate huge page memory")
+PCI_COMMAND = 0x04
+PCI_CAPABILITY_LIST = 0x34
+PCI_CAP_ID_EXP = 0x10
+PCI_EXP_DEVCTL2 = 0x28
 
-os.system("setpci  -s 01:00.0 COMMAND=0x02")
-os.system("setpci  -s 01:00.0 98.b=0x16")  # 98 = 0x70(base) + 0x28(DevCtl2 offset), 0x16 means disable completion timeout
-os.system("setpci  -s 01:00.0 CAP_EXP+28.w=0x1000")  # enable 10 bit tag
 
+def _find_pci_cap(fd, cap_id):
+    pos = os.pread(fd, 1, PCI_CAPABILITY_LIST)[0] & ~0x3
+    for _ in range(48):  # 防止链表成环
+        if not pos:
+            break
+        cap, next_pos = os.pread(fd, 2, pos)
+        if cap == cap_id:
+            return pos
+        pos = next_pos & ~0x3
+    raise RuntimeError(f"PCI capability {hex(cap_id)} not found")
 
-# 使用内存（示例）
 
-va_src = addr
-va_dst = addr + 1024*1024
+def setup_pci_config():
+    """Apply the config space settings the tests rely on, writing sysfs config directly instead of running setpci."""
+    fd = os.open('/sys/bus/pci/devices/0000:01:00.0/config', os.O_RDWR)
+    try:
+        os.pwrite(fd, (0x02).to_bytes(2, 'little'), PCI_COMMAND)  # COMMAND=0x02
+        os.pwrite(fd, (0x16).to_bytes(1, 'little'), 0x98)  # 98 = 0x70(base) + 0x28(DevCtl2 offset), 0x16 means disable completion timeout
+        cap_exp = _find_pci_cap(fd, PCI_CAP_ID_EXP)
+        os.pwrite(fd, (0x1000).to_bytes(2, 'little'), cap_exp + PCI_EXP_DEVCTL2)  # enable 10 bit tag
+    finally:
+        os.close(fd)
 
-src_buffer = (ctypes.c_char * size).from_address(va_src)
-dst_buffer = (ctypes.c_char * size).from_address(va_dst)
 
+# throughput test polling: backoff between counter reads (s) and speed report period (ns)
+POLL_BACKOFF = 0.001
+SPEED_REPORT_INTERVAL_NS = 1_000_000_000
 
-def test_throughput():
-    for offset in range(0, 1024*1024, 4):
-        src_buffer[offset:offset + 4] = (offset//4).to_bytes(4, byteorder="little")
-        dst_buffer[offset:offset + 4] = (0).to_bytes(4, byteorder="little")
-    
+# correctness test: at most this many bad bytes are printed per check
+MAX_REPORTED_ERRORS = 100
+
+
+def _map_bar(index):
+    with open(f'/sys/bus/pci/devices/0000:01:00.0/resource{index}', 'r+b') as f:
+        # 将文件映射到内存
+        mm = mmap.mmap(f.fileno(), 0)
+    mm.madvise(mmap.MADV_DONTFORK)
+    return mm
+
+
+def _csr_field(offset):
+    """Property for the 32-bit register at byte `offset`: each get/set is one uint32 view access."""
+    index = offset // 4
+
+    def get(self):
+        return self._regs[index]
+
+    def set(self, value):
+        self._regs[index] = value
+
+    return property(get, set)
+
+
+class DmaTestCsr:
+    """DMA test register block at the start of a BAR, accessed as named 32-bit registers.
+
+    Registers go through the uint32 view of the BAR, so a write is a single 32-bit store with no
+    read before it (a ctypes.Structure field store reads the field first). Do not batch a run of
+    registers into one slice/memcpy: the BAR is uncached, and memcpy emits wide, overlapping
+    vector stores, so the device would see 128-bit writes and some registers written twice.
+    """
+    __slots__ = ('_regs',)
+
+    def __init__(self, regs):
+        self._regs = regs
+
+    src_addr_low = _csr_field(0x04)
+    src_addr_high = _csr_field(0x08)
+    dst_addr_low = _csr_field(0x0c)
+    dst_addr_high = _csr_field(0x10)
+    length = _csr_field(0x14)
+    batch_test_counter_a = _csr_field(0x18)  # 写入即启动测试
+    stride_size = _csr_field(0x1c)
+    max_stride_cnt = _csr_field(0x20)
+    attr = _csr_field(0x24)
+    double_channel_test_offset = _csr_field(0x28)
+    test_mode_ctl = _csr_field(0x2c)
+    batch_test_counter_b = _csr_field(0x30)
+
+
+class DeviceContext:
+    """DMA buffer and BAR mappings shared by the tests selected in one run.
+
+    The src/dst halves of the huge page buffer are exposed as ctypes arrays and uint8 numpy views.
+    Each BAR is mapped on first use and kept until the process exits.
+    """
+
+    def __init__(self, addr, page_size):
+        self.addr = addr
+        self.page_size = page_size
+
+        self.va_src = addr
+        self.va_dst = addr + 1024*1024
+        # src 和 dst 各占 2MB 缓冲区的一半
+        self.src_buffer = (ctypes.c_char * (1024*1024)).from_address(self.va_src)
+        self.dst_buffer = (ctypes.c_char * (1024*1024)).from_address(self.va_dst)
+        self.src_np = np.frombuffer(self.src_buffer, dtype=np.uint8)
+        self.dst_np = np.frombuffer(self.dst_buffer, dtype=np.uint8)
+
+        self._bar_regs = {}
+
+    def bar_regs(self, index):
+        """uint32 view of BAR `index`, mapping it on first use."""
+        regs = self._bar_regs.get(index)
+        if regs is None:
+            regs = self._bar_regs[index] = memoryview(_map_bar(index)).cast('I')
+        return regs
+
+    def csr(self, index):
+        return DmaTestCsr(self.bar_regs(index))
+
+
+def setup_device():
+    """Allocate and pin the DMA buffer and program PCI config space; BARs are mapped later, on demand."""
+    addr, page_size = mmap_with_hugepage_fallback(size)
+    advise_dma_buffer(addr, size)
+    pin_dma_buffer(addr, size)
+    # 巨页在整个进程生命周期内复用, 退出时再释放
+    atexit.register(libc.munmap, addr, size)
+
+    setup_pci_config()
+    return DeviceContext(addr, page_size)
+
+
+def test_throughput(dev, csr):
+    dev.src_np[:1024*1024].view('<u4')[:] = np.arange(1024*1024 // 4, dtype='<u4')
+    ctypes.memset(dev.va_dst, 0, 1024*1024)
     
-    src_buffer[:5] = b'Hello'  # 写入数据
-    print(src_buffer[:10])       # 读取数据
-    dst_buffer[:5] = b'world'  # 写入数据
-    print(dst_buffer[:10])
     
-    pa_src = va_to_pa(addr) # + 2
+    dev.src_buffer[:5] = b'Hello'  # 写入数据
+    logger.debug("%s", dev.src_buffer[:10])       # 读取数据
+    dev.dst_buffer[:5] = b'world'  # 写入数据
+    logger.debug("%s", dev.dst_buffer[:10])
     
-    pa_dst = va_to_pa(addr + 1024*1024) # + 3
+    pa_src, pa_dst = va_to_pa_pair(dev.addr, dev.addr + 1024*1024, dev.page_size)
     
     req_size = 4096
     stride_size = 0
@@ -96,266 +296,286 @@ def test_throughput():
     double_channel_offset = 1024*512 # double channel test enabled
     # double_channel_offset = 0 # double channel test disabled
     
-    with open('/sys/bus/pci/devices/0000:01:00.0/resource1', 'r+b') as f:
-        # 将文件映射到内存
-        with mmap.mmap(f.fileno(), 0) as mm:
-    
-            struct.pack_into('<I', mm, 0x4, pa_src & 0xFFFFFFFF)
-            struct.pack_into('<I', mm, 0x8, pa_src >> 32)
-            struct.pack_into('<I', mm, 0xc, pa_dst & 0xFFFFFFFF)
-            struct.pack_into('<I', mm, 0x10, pa_dst >> 32)
-            struct.pack_into('<I', mm, 0x14, req_size)
-            struct.pack_into('<I', mm, 0x1c, stride_size)
-            struct.pack_into('<I', mm, 0x20, stride_cnt)
-            struct.pack_into('<I', mm, 0x24, 0b000_000)
-
-            struct.pack_into('<I', mm, 0x28, double_channel_offset)  
-
-            # struct.pack_into('<I', mm, 0x2C, 0b00)  # read write test
-            # struct.pack_into('<I', mm, 0x2C, 0b01)  # read only test
-            struct.pack_into('<I', mm, 0x2C, 0b10)  # write only test
     
-            print(hex(struct.unpack_from('<I', mm, offset=0x4)[0]))
-            print(hex(struct.unpack_from('<I', mm, offset=0x8)[0]))
-            print(hex(struct.unpack_from('<I', mm, offset=0xc)[0]))
-            print(hex(struct.unpack_from('<I', mm, offset=0x10)[0]))
-            print(hex(struct.unpack_from('<I', mm, offset=0x14)[0]))
-            
+    csr.src_addr_low = pa_src & 0xFFFFFFFF
+    csr.src_addr_high = pa_src >> 32
+    csr.dst_addr_low = pa_dst & 0xFFFFFFFF
+    csr.dst_addr_high = pa_dst >> 32
+    csr.length = req_size
+    csr.stride_size = stride_size
+    csr.max_stride_cnt = stride_cnt
+    csr.attr = 0b000_000
+
+    csr.double_channel_test_offset = double_channel_offset  
+
+    # csr.test_mode_ctl = 0b00  # read write test
+    # csr.test_mode_ctl = 0b01  # read only test
+    csr.test_mode_ctl = 0b10  # write only test
     
+    logger.debug("%#x", csr.src_addr_low)
+    logger.debug("%#x", csr.src_addr_high)
+    logger.debug("%#x", csr.dst_addr_low)
+    logger.debug("%#x", csr.dst_addr_high)
+    logger.debug("%#x", csr.length)
     
-            last_time = time.time()
-            iter_last_a = 1
-            iter_now_a = 2
-            iter_last_b = 1
-            iter_now_b = 2
-            for _ in range(1):
-                struct.pack_into('<I', mm, 0x18, 0x1ffffff)
-                iter_last_a = struct.unpack_from('<I', mm, offset=0x18)[0]
-                iter_last_b = struct.unpack_from('<I', mm, offset=0x30)[0]
-                while iter_last_a != 0 or iter_last_b != 0:
-                
-                    time.sleep(1)
-                    iter_now_a = struct.unpack_from('<I', mm, offset=0x18)[0]
-                    iter_now_b = struct.unpack_from('<I', mm, offset=0x30)[0]
-
-                    now_time = time.time()
-                
-                    time_delta = now_time - last_time
-                    iter_delta_a = iter_last_a - iter_now_a
-                    iter_delta_b = iter_last_b - iter_now_b
-                    iter_delta = iter_delta_a + iter_delta_b
-                    speed = (iter_delta * req_size * 8) / time_delta / 1024 / 1024 / 1024
     
-                    print(f"speed = {speed} Gbps, iter_left_a={iter_last_a}, iter_left_b={iter_last_b}")
-                    iter_last_a = iter_now_a
-                    iter_last_b = iter_now_b
-                    last_time = now_time
     
+    debug_enabled = logger.isEnabledFor(logging.DEBUG)
+    for _ in range(1):
+        csr.batch_test_counter_a = 0x1ffffff
+        iter_last_a = csr.batch_test_counter_a
+        iter_last_b = csr.batch_test_counter_b
+        start_ns = last_ns = time.perf_counter_ns()
+        iter_start = iter_last_a + iter_last_b
+        iter_now_a = iter_last_a
+        iter_now_b = iter_last_b
+        while iter_now_a != 0 or iter_now_b != 0:
+            time.sleep(POLL_BACKOFF)
+            iter_now_a = csr.batch_test_counter_a
+            iter_now_b = csr.batch_test_counter_b
+            if not debug_enabled:
+                continue
+
+            now_ns = time.perf_counter_ns()
+            dt_ns = now_ns - last_ns
+            if dt_ns < SPEED_REPORT_INTERVAL_NS and (iter_now_a != 0 or iter_now_b != 0):
+                continue
+
+            iter_delta_a = iter_last_a - iter_now_a
+            iter_delta_b = iter_last_b - iter_now_b
+            iter_delta = iter_delta_a + iter_delta_b
+            speed = (iter_delta * req_size * 8 * 1_000_000_000) // dt_ns  # bit/s
+
+            logger.debug("speed = %.3f Gbps, iter_left_a=%d, iter_left_b=%d", speed / (1 << 30), iter_now_a, iter_now_b)
+            iter_last_a = iter_now_a
+            iter_last_b = iter_now_b
+            last_ns = now_ns
+
+        total_ns = time.perf_counter_ns() - start_ns
+        speed = (iter_start * req_size * 8 * 1_000_000_000) // total_ns  # bit/s
+        print(f"average speed = {speed / (1 << 30):.3f} Gbps, elapsed = {total_ns / 1_000_000_000} s")
+
     time.sleep(0.1)
     
-    print(dst_buffer[:10])
+    logger.debug("%s", dev.dst_buffer[:10])
 
 
 
-def test_correct():
-    for offset in range(0, 1024*1024, 1):
-        src_buffer[offset] = offset % 256
-        dst_buffer[offset] = 0
+def test_correct(dev, csr):
+    dev.src_np[:1024*1024] = np.tile(np.arange(256, dtype=np.uint8), 1024*1024 // 256)
+    ctypes.memset(dev.va_dst, 0, 1024*1024)
     
     
     
-    pa_src = va_to_pa(addr)
+    pa_src, pa_dst = va_to_pa_pair(dev.addr, dev.addr + 1024*1024, dev.page_size)
     
-    pa_dst = va_to_pa(addr + 1024*1024)
     
-    
-    with open('/sys/bus/pci/devices/0000:01:00.0/resource0', 'r+b') as f:
-        # 将文件映射到内存
-        with mmap.mmap(f.fileno(), 0) as mm:
 
 
-            iter_last = struct.unpack_from('<I', mm, offset=0x18)[0]
-            print(hex(iter_last))
+    iter_last = csr.batch_test_counter_a
+    print(hex(iter_last))
 
-            raise SystemExit
+    return
 
 
 
 
-            last_time = time.time()
-            iter_last = 1
-            iter_now = 2
-            for iter_idx in range(100):
+    last_time = time.time()
+    iter_last = 1
+    iter_now = 2
+    # 预先生成所有迭代的随机参数, 保证 req_size + src_offset <= 512
+    rng = np.random.default_rng()
+    src_offsets = rng.integers(0, 512, size=100)
+    req_sizes = rng.integers(1, 513 - src_offsets)
+    for iter_idx in range(100):
 
-                print(f"iter={iter_idx}")
+        logger.debug("iter=%d", iter_idx)
 
-                while True:
-                    req_size = random.randint(1, 512)
-                    stride_size = 0 #req_size
-                    stride_cnt = 0 # random.randint(1, 8)
+        req_size = int(req_sizes[iter_idx])
+        stride_size = 0 #req_size
+        stride_cnt = 0 # random.randint(1, 8)
 
-                    src_offset = random.randint(0, 511)
-                    dst_offset = src_offset # random.randint(0, 1024*512)
+        src_offset = int(src_offsets[iter_idx])
+        dst_offset = src_offset # random.randint(0, 1024*512)
 
-                    if (req_size + src_offset <= 512):
-                        break
-                req_cnt = stride_cnt
+        req_cnt = stride_cnt
 
 
-                # req_size = 8 # random.randint(1, 4096)
-                # stride_size = req_size
-                # stride_cnt = 1 # random.randint(1, 8)
-                
-                # src_offset = 0 # random.randint(0, 1024*128)
-                # dst_offset =  1 # random.randint(0, 1024*512)
+        # req_size = 8 # random.randint(1, 4096)
+        # stride_size = req_size
+        # stride_cnt = 1 # random.randint(1, 8)
+        
+        # src_offset = 0 # random.randint(0, 1024*128)
+        # dst_offset =  1 # random.randint(0, 1024*512)
 
-                # req_cnt = stride_cnt
+        # req_cnt = stride_cnt
 
-                struct.pack_into('<I', mm, 0x4, (pa_src + src_offset) & 0xFFFFFFFF)
-                struct.pack_into('<I', mm, 0x8, pa_src >> 32)
-                struct.pack_into('<I', mm, 0xc, (pa_dst + dst_offset) & 0xFFFFFFFF)
-                struct.pack_into('<I', mm, 0x10, pa_dst >> 32)
-                struct.pack_into('<I', mm, 0x14, req_size)
-                struct.pack_into('<I', mm, 0x1c, stride_size)
-                struct.pack_into('<I', mm, 0x20, stride_cnt)
-                struct.pack_into('<I', mm, 0x24, 0b000)
-                struct.pack_into('<I', mm, 0x28, 0b000)
-                struct.pack_into('<I', mm, 0x2C, 0b000)   # read write
-                struct.pack_into('<I', mm, 0x30, 0b000)
+        csr.src_addr_low = (pa_src + src_offset) & 0xFFFFFFFF
+        csr.src_addr_high = pa_src >> 32
+        csr.dst_addr_low = (pa_dst + dst_offset) & 0xFFFFFFFF
+        csr.dst_addr_high = pa_dst >> 32
+        csr.length = req_size
+        csr.stride_size = stride_size
+        csr.max_stride_cnt = stride_cnt
+        csr.attr = 0b000
+        csr.double_channel_test_offset = 0b000
+        csr.test_mode_ctl = 0b000   # read write
+        csr.batch_test_counter_b = 0b000
 
     
-                print("srcAddrLowReg=", hex(struct.unpack_from('<I', mm, offset=0x4)[0]))
-                print("srcAddrHighReg=", hex(struct.unpack_from('<I', mm, offset=0x8)[0]))
-                print("dstAddrLowReg=", hex(struct.unpack_from('<I', mm, offset=0xc)[0]))
-                print("dstAddrHighReg=", hex(struct.unpack_from('<I', mm, offset=0x10)[0]))
-                print("lengthReg=", hex(struct.unpack_from('<I', mm, offset=0x14)[0]))
-                print("batchTestCounterAReg=", hex(struct.unpack_from('<I', mm, offset=0x18)[0]))
-                print("strideSizeReg=", hex(struct.unpack_from('<I', mm, offset=0x1C)[0]))
-                print("maxStrideCntReg=", hex(struct.unpack_from('<I', mm, offset=0x20)[0]))
-                print("attrReg=", hex(struct.unpack_from('<I', mm, offset=0x24)[0]))
-                print("doubleChannelTestOffsetReg=", hex(struct.unpack_from('<I', mm, offset=0x28)[0]))
-                print("testModeCtlReg=", hex(struct.unpack_from('<I', mm, offset=0x2C)[0]))
-                print("batchTestCounterBReg=", hex(struct.unpack_from('<I', mm, offset=0x30)[0]))
-
-                print(f"src_offset = {hex(src_offset)}, dst_offset = {hex(dst_offset)}, req_size={hex(req_size)}, stride_cnt={hex(stride_cnt)}, src_addr={hex(pa_src + src_offset)}, dst_addr={hex(pa_dst + dst_offset)}")
-                # input("press enter to continue")
-                struct.pack_into('<I', mm, 0x18, req_cnt)
-
-
-                while iter_last != 0:
-                    # time.sleep(1)
-                    # input("press enter to continue")
-                    iter_last = struct.unpack_from('<I', mm, offset=0x18)[0]
-                    print(hex(iter_last))
-                #input()
-                #time.sleep(1)
-                total_bytes_copy = req_size * req_cnt
+        logger.debug("srcAddrLowReg=%#x", csr.src_addr_low)
+        logger.debug("srcAddrHighReg=%#x", csr.src_addr_high)
+        logger.debug("dstAddrLowReg=%#x", csr.dst_addr_low)
+        logger.debug("dstAddrHighReg=%#x", csr.dst_addr_high)
+        logger.debug("lengthReg=%#x", csr.length)
+        logger.debug("batchTestCounterAReg=%#x", csr.batch_test_counter_a)
+        logger.debug("strideSizeReg=%#x", csr.stride_size)
+        logger.debug("maxStrideCntReg=%#x", csr.max_stride_cnt)
+        logger.debug("attrReg=%#x", csr.attr)
+        logger.debug("doubleChannelTestOffsetReg=%#x", csr.double_channel_test_offset)
+        logger.debug("testModeCtlReg=%#x", csr.test_mode_ctl)
+        logger.debug("batchTestCounterBReg=%#x", csr.batch_test_counter_b)
+
+        logger.debug("src_offset = %#x, dst_offset = %#x, req_size=%#x, stride_cnt=%#x, src_addr=%#x, dst_addr=%#x",
+                     src_offset, dst_offset, req_size, stride_cnt, pa_src + src_offset, pa_dst + dst_offset)
+        # input("press enter to continue")
+        csr.batch_test_counter_a = req_cnt
+
+
+        while iter_last != 0:
+            # time.sleep(1)
+            # input("press enter to continue")
+            iter_last = csr.batch_test_counter_a
+            logger.debug("%#x", iter_last)
+        #input()
+        #time.sleep(1)
+        total_bytes_copy = req_size * req_cnt
     
 
-                for offset in range(0, dst_offset, 1):
-                    if dst_buffer[offset] != b'\x00':
-                        print(f"should not be modified, dst_buffer[{hex(offset)})={hex(int.from_bytes(dst_buffer[offset], byteorder='little'))}")
-                        # raise SystemExit
-
-                
-                for (s_offset, d_offset) in zip(range(src_offset, src_offset + total_bytes_copy, 1), range(dst_offset, dst_offset + total_bytes_copy, 1)):
-                    if dst_buffer[d_offset] != src_buffer[s_offset]:
-                        time.sleep(0.1) 
-                        if dst_buffer[d_offset] != src_buffer[s_offset]:
-                            print(f"not match, dst_buffer[{hex(d_offset)}]={hex(int.from_bytes(dst_buffer[d_offset], byteorder='little'))}, src_buffer[{hex(s_offset)}]={hex(int.from_bytes(src_buffer[s_offset],byteorder='little'))}")
-                            # raise SystemExit
-                    dst_buffer[d_offset] = 0
-
-                for offset in range(dst_offset + total_bytes_copy, 1024 * 256, 1):
-                    if dst_buffer[offset] != b'\x00':
-                        print(f"should not be modified, dst_buffer[{hex(offset)})={hex(int.from_bytes(dst_buffer[offset], byteorder='little'))}")
-                        # raise SystemExit
-
-
-
-def pcie_p2p():
-
-    for offset in range(0, 1024*1024, 1):
-        src_buffer[offset] = 0
-        dst_buffer[offset] = 0
-
-    # pa_src = va_to_pa(addr)
+        if total_bytes_copy:
+            src_region = dev.src_np[src_offset:src_offset + total_bytes_copy]
+            dst_region = dev.dst_np[dst_offset:dst_offset + total_bytes_copy]
+            if not np.array_equal(dst_region, src_region):
+                time.sleep(0.1)
+                mismatch = np.flatnonzero(dst_region != src_region)
+                for idx in mismatch[:MAX_REPORTED_ERRORS]:
+                    print(f"not match at dst {hex(int(dst_offset + idx))} / src {hex(int(src_offset + idx))}: dst={dst_region[idx]:#x} src={src_region[idx]:#x}")
+                    # raise SystemExit
+                if mismatch.size > MAX_REPORTED_ERRORS:
+                    print(f"{mismatch.size} bytes not match in total")
+            dst_region[:] = 0
+
+        # 拷贝区域已清零, 检查窗口内其余字节应当都未被修改
+        if np.any(dev.dst_np[:1024 * 256]):
+            bad = np.flatnonzero(dev.dst_np[:dst_offset])
+            for offset in bad[:MAX_REPORTED_ERRORS]:
+                print(f"should not be modified at {hex(int(offset))}: dst={dev.dst_np[offset]:#x}")
+                # raise SystemExit
+
+            bad = np.flatnonzero(dev.dst_np[dst_offset + total_bytes_copy:1024 * 256]) + (dst_offset + total_bytes_copy)
+            for offset in bad[:MAX_REPORTED_ERRORS]:
+                print(f"should not be modified at {hex(int(offset))}: dst={dev.dst_np[offset]:#x}")
+                # raise SystemExit
+
+
+def pcie_p2p(dev, csr):
+
+    ctypes.memset(dev.va_src, 0, 1024*1024)
+    ctypes.memset(dev.va_dst, 0, 1024*1024)
+
+    # pa_src = va_to_pa(dev.addr)
     # pa_dst = 0xfb800000
     # src_offset =  0x00
     # dst_offset =  0x1048
     
 
     pa_src = 0xfb800000
-    pa_dst = va_to_pa(addr + 1024*1024)
+    pa_dst = va_to_pa(dev.addr + 1024*1024)
     src_offset =  0x1048
     dst_offset =  0x00
 
-    with open('/sys/bus/pci/devices/0000:01:00.0/resource1', 'r+b') as f:
-        # 将文件映射到内存
-        with mmap.mmap(f.fileno(), 0) as mm:
 
-            req_size =  4
-            stride_size = 1
-            stride_cnt =  1
-            
-            req_cnt = stride_cnt
+    req_size =  4
+    stride_size = 1
+    stride_cnt =  1
+    
+    req_cnt = stride_cnt
 
-            struct.pack_into('<I', mm, 0x4, (pa_src + src_offset) & 0xFFFFFFFF)
-            struct.pack_into('<I', mm, 0x8, pa_src >> 32)
-            struct.pack_into('<I', mm, 0xc, (pa_dst + dst_offset) & 0xFFFFFFFF)
-            struct.pack_into('<I', mm, 0x10, pa_dst >> 32)
-            struct.pack_into('<I', mm, 0x14, req_size)
-            struct.pack_into('<I', mm, 0x1c, stride_size)
-            struct.pack_into('<I', mm, 0x20, stride_cnt)
+    csr.src_addr_low = (pa_src + src_offset) & 0xFFFFFFFF
+    csr.src_addr_high = pa_src >> 32
+    csr.dst_addr_low = (pa_dst + dst_offset) & 0xFFFFFFFF
+    csr.dst_addr_high = pa_dst >> 32
+    csr.length = req_size
+    csr.stride_size = stride_size
+    csr.max_stride_cnt = stride_cnt
 
-            print(f"src_offset = {hex(src_offset)}, dst_offset = {hex(dst_offset)}, req_size={hex(req_size)}, stride_cnt={hex(stride_cnt)}, src_addr={hex(pa_src + src_offset)}, dst_addr={hex(pa_dst + dst_offset)}")
+    logger.debug("src_offset = %#x, dst_offset = %#x, req_size=%#x, stride_cnt=%#x, src_addr=%#x, dst_addr=%#x",
+                 src_offset, dst_offset, req_size, stride_cnt, pa_src + src_offset, pa_dst + dst_offset)
 
-            struct.pack_into('<I', mm, 0x18, req_cnt)
+    csr.batch_test_counter_a = req_cnt
 
-            time.sleep(0.01)
+    time.sleep(0.01)
 
-            total_bytes_copy = req_size * req_cnt
+    total_bytes_copy = req_size * req_cnt
 
-            print(f'read result =  {hex(int.from_bytes(dst_buffer[0:4],byteorder="little"))}')
+    print(f'read result =  {hex(int.from_bytes(dev.dst_buffer[0:4],byteorder="little"))}')
     
 
-def dump_csr():
-    with open('/sys/bus/pci/devices/0000:01:00.0/resource0', 'r+b') as f:
-        # 将文件映射到内存
-        with mmap.mmap(f.fileno(), 0) as mm:
-            print("CSR_WQE_RINGBUF_HEAD=", hex(struct.unpack_from('<I', mm, offset=(0x0002 << 2))[0]))
-            print("CSR_WQE_RINGBUF_TAIL=", hex(struct.unpack_from('<I', mm, offset=(0x0003 << 2))[0]))
+# dump_csr 打印的 CSR 编号: 全局 ring buffer 指针以及每个通道的计数器
+CSR_DUMP_INDEXES = (0x0002, 0x0003, 0x0006, 0x0007) + tuple(
+    0x0100 * ch_idx + reg for ch_idx in range(4) for reg in (*range(0x0100, 0x010b), *range(0x0120, 0x0124))
+)
+
+
+def dump_csr(regs):
+    # 先把要打印的寄存器逐个 (32 位) 读出来, 再统一打印, 不读取未定义的 CSR
+    words = {idx: regs[idx] for idx in CSR_DUMP_INDEXES}
+
+    print("CSR_WQE_RINGBUF_HEAD=", hex(words[0x0002]))
+    print("CSR_WQE_RINGBUF_TAIL=", hex(words[0x0003]))
+
+    print("CSR_META_REPORT_RINGBUF_HEAD=", hex(words[0x0006]))
+    print("CSR_META_REPORT_RINGBUF_TAIL=", hex(words[0x0007]))
+
 
-            print("CSR_META_REPORT_RINGBUF_HEAD=", hex(struct.unpack_from('<I', mm, offset=(0x0006 << 2))[0]))
-            print("CSR_META_REPORT_RINGBUF_TAIL=", hex(struct.unpack_from('<I', mm, offset=(0x0007 << 2))[0]))
+    for ch_idx in range(4):
+        channel_offset = 0x0100 * ch_idx
+        print(f"CSR_CH{ch_idx}_ETH_IO_DISCARD_PACKET_CNT=   ", hex(words[channel_offset + 0x0120]))
+        print(f"CSR_CH{ch_idx}_ETH_IO_SIMPLE_NIC_PACKET_CNT=", hex(words[channel_offset + 0x0121]))
+        print(f"CSR_CH{ch_idx}_ETH_IO_RDMA_PACKET_CNT=      ", hex(words[channel_offset + 0x0122]))
+        print(f"CSR_CH{ch_idx}_ETH_IO_NOT_READY_PACKET_CNT= ", hex(words[channel_offset + 0x0123]))
 
+        print(f"CSR_CH{ch_idx}_RQ_PACKET_VERIFY_INV_QP_ACCESS_FLAG_CNT= ", hex(words[channel_offset + 0x0100]))
+        print(f"CSR_CH{ch_idx}_RQ_PACKET_VERIFY_INV_OPCODE_CNT=         ", hex(words[channel_offset + 0x0101]))
+        print(f"CSR_CH{ch_idx}_RQ_PACKET_VERIFY_INV_MR_KEY_CNT=         ", hex(words[channel_offset + 0x0102]))
+        print(f"CSR_CH{ch_idx}_RQ_PACKET_VERIFY_MEM_OOB_CNT=            ", hex(words[channel_offset + 0x0103]))
+        print(f"CSR_CH{ch_idx}_RQ_PACKET_VERIFY_INV_MR_ACCESS_FLAG_CNT= ", hex(words[channel_offset + 0x0104]))
+        print(f"CSR_CH{ch_idx}_RQ_PACKET_VERIFY_INV_HEADER_CNT=         ", hex(words[channel_offset + 0x0105]))
+        print(f"CSR_CH{ch_idx}_RQ_PACKET_VERIFY_INV_QP_CTX_CNT=         ", hex(words[channel_offset + 0x0106]))
+        print(f"CSR_CH{ch_idx}_RQ_PACKET_VERIFY_PKT_LEN_ERR_CNT=        ", hex(words[channel_offset + 0x0107]))
+        print(f"CSR_CH{ch_idx}_RQ_PACKET_VERIFY_UNKNOWN_ERR_CNT=        ", hex(words[channel_offset + 0x0108]))
+        print(f"CSR_CH{ch_idx}_RQ_DEBUG_COUNTER_1=                      ", hex(words[channel_offset + 0x0109]))
+        print(f"CSR_CH{ch_idx}_RQ_DEBUG_QUEUE_FULL_FLAG=                ", hex(words[channel_offset + 0x010a]))
 
-            for ch_idx in range(4):
-                channel_offset = 0x0100 * ch_idx
-                print(f"CSR_CH{ch_idx}_ETH_IO_DISCARD_PACKET_CNT=   ", hex(struct.unpack_from('<I', mm, offset=((channel_offset + 0x0120) << 2))[0]))
-                print(f"CSR_CH{ch_idx}_ETH_IO_SIMPLE_NIC_PACKET_CNT=", hex(struct.unpack_from('<I', mm, offset=((channel_offset + 0x0121) << 2))[0]))
-                print(f"CSR_CH{ch_idx}_ETH_IO_RDMA_PACKET_CNT=      ", hex(struct.unpack_from('<I', mm, offset=((channel_offset + 0x0122) << 2))[0]))
-                print(f"CSR_CH{ch_idx}_ETH_IO_NOT_READY_PACKET_CNT= ", hex(struct.unpack_from('<I', mm, offset=((channel_offset + 0x0123) << 2))[0]))
 
-                print(f"CSR_CH{ch_idx}_RQ_PACKET_VERIFY_INV_QP_ACCESS_FLAG_CNT= ", hex(struct.unpack_from('<I', mm, offset=((channel_offset + 0x0100) << 2))[0]))
-                print(f"CSR_CH{ch_idx}_RQ_PACKET_VERIFY_INV_OPCODE_CNT=         ", hex(struct.unpack_from('<I', mm, offset=((channel_offset + 0x0101) << 2))[0]))
-                print(f"CSR_CH{ch_idx}_RQ_PACKET_VERIFY_INV_MR_KEY_CNT=         ", hex(struct.unpack_from('<I', mm, offset=((channel_offset + 0x0102) << 2))[0]))
-                print(f"CSR_CH{ch_idx}_RQ_PACKET_VERIFY_MEM_OOB_CNT=            ", hex(struct.unpack_from('<I', mm, offset=((channel_offset + 0x0103) << 2))[0]))
-                print(f"CSR_CH{ch_idx}_RQ_PACKET_VERIFY_INV_MR_ACCESS_FLAG_CNT= ", hex(struct.unpack_from('<I', mm, offset=((channel_offset + 0x0104) << 2))[0]))
-                print(f"CSR_CH{ch_idx}_RQ_PACKET_VERIFY_INV_HEADER_CNT=         ", hex(struct.unpack_from('<I', mm, offset=((channel_offset + 0x0105) << 2))[0]))
-                print(f"CSR_CH{ch_idx}_RQ_PACKET_VERIFY_INV_QP_CTX_CNT=         ", hex(struct.unpack_from('<I', mm, offset=((channel_offset + 0x0106) << 2))[0]))
-                print(f"CSR_CH{ch_idx}_RQ_PACKET_VERIFY_PKT_LEN_ERR_CNT=        ", hex(struct.unpack_from('<I', mm, offset=((channel_offset + 0x0107) << 2))[0]))
-                print(f"CSR_CH{ch_idx}_RQ_PACKET_VERIFY_UNKNOWN_ERR_CNT=        ", hex(struct.unpack_from('<I', mm, offset=((channel_offset + 0x0108) << 2))[0]))
-                print(f"CSR_CH{ch_idx}_RQ_DEBUG_COUNTER_1=                      ", hex(struct.unpack_from('<I', mm, offset=((channel_offset + 0x0109) << 2))[0]))
-                print(f"CSR_CH{ch_idx}_RQ_DEBUG_QUEUE_FULL_FLAG=                ", hex(struct.unpack_from('<I', mm, offset=((channel_offset + 0x010a) << 2))[0]))
+TESTS = {
+    'dump_csr': lambda dev: dump_csr(dev.bar_regs(0)),
+    'test_correct': lambda dev: test_correct(dev, dev.csr(0)),
+    'test_throughput': lambda dev: test_throughput(dev, dev.csr(1)),
+    'pcie_p2p': lambda dev: pcie_p2p(dev, dev.csr(1)),
+}
 
 
-dump_csr()
-# test_correct()
-# test_throughput()
-# pcie_p2p()
+def main(argv):
+    """Run the tests named in `argv` in order (dump_csr by default), all sharing one DMA buffer and BAR mapping."""
+    # RDMA_DEBUG=1 打开调试输出 (寄存器回读, 周期性速率等)
+    level = logging.DEBUG if os.environ.get('RDMA_DEBUG') else logging.INFO
+    logging.basicConfig(level=level, format='%(message)s')
 
+    dev = setup_device()
+    for name in argv or ['dump_csr']:
+        TESTS[name](dev)
 
-# 释放内存
-libc.munmap(addr, size)
 
+if __name__ == '__main__':
+    main(sys.argv[1:])